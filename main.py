@@ -1,13 +1,24 @@
 import os
-import re
+import io
+import json
 import time
+import random
 import base64
+import binascii
+import asyncio
 import mimetypes
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel, Field
-import requests
-from openai import OpenAI
-from github import Github, GithubException
+from typing import Optional
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field, ValidationError
+import httpx
+import orjson
+import diskcache
+from blake3 import blake3
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI
 
 # --- 1. SETUP AND CONFIGURATION ---
 
@@ -23,15 +34,109 @@ GITHUB_USERNAME = "mohdsamad83"
 # Set the base URL to AIPipe's OpenRouter-compatible endpoint
 AIPipe_BASE_URL = "https://aipipe.org/openrouter/v1" 
 
+# --- Optional: OpenAI Batch API (`use_batch` tasks) ---
+# AIPipe's OpenRouter proxy has no /v1/files or /v1/batches, so batch jobs go straight to OpenAI
+# with a native model id. Without this key, `use_batch` requests are rejected up front.
+OPENAI_BATCH_API_KEY = os.getenv("OPENAI_BATCH_API_KEY")
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+BATCH_MODEL_NAME = "gpt-4o-mini"
+
 # Check if all required secrets are set
 if not all([MY_SECRET, GITHUB_TOKEN, OPENAI_API_KEY, GITHUB_USERNAME]):
     raise ValueError("One or more required environment variables or GITHUB_USERNAME are not set.")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Resolves the GitHub login once at startup, so no task pays for the /user lookup,
+    and closes the pooled clients (and their keep-alive connections) when the server shuts down.
+    """
+    global task_queue, batch_task_queue
+    try:
+        await get_github_login()
+    except httpx.HTTPError as e:
+        # Not fatal: get_github_login() will fetch it lazily on the first task instead
+        print(f"⚠️ Could not resolve GitHub login at startup: {e}")
+    start_task_workers()
+    yield
+    # Stop the workers and forget them, so a later startup in the same process starts fresh ones
+    workers = task_workers + batch_task_workers
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    task_workers.clear()
+    batch_task_workers.clear()
+    # A queue is bound to the event loop that first waited on it, so a later startup gets new ones
+    task_queue = asyncio.Queue(maxsize=MAX_QUEUED_TASKS)
+    batch_task_queue = asyncio.Queue(maxsize=MAX_QUEUED_TASKS)
+    await asyncio.gather(github_http.aclose(), evaluation_http.aclose(), openai_client.close())
+    if batch_client is not None:
+        await batch_client.close()
+    llm_cache.close()
+
 # Initialize clients for the APIs we'll use
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # 🔑 CRITICAL CHANGE: Initialize OpenAI client with the AIPipe base_url
-openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=AIPipe_BASE_URL)
-github_client = Github(GITHUB_TOKEN)
+# The async client lets the LLM call (the slowest step by far) run on the event loop
+# instead of pinning a worker thread for its whole duration.
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=AIPipe_BASE_URL)
+# Separate client for the Batch API, which only OpenAI itself serves (None when not configured)
+batch_client = AsyncOpenAI(api_key=OPENAI_BATCH_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_BATCH_API_KEY else None
+# One pooled HTTP/2 client for every GitHub REST call, so the handful of calls each task makes
+# share a single TLS connection instead of paying a fresh handshake per request
+github_http = httpx.AsyncClient(
+    base_url="https://api.github.com",
+    headers={
+        "Authorization": f"Bearer {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    },
+    http2=True,
+    timeout=30.0
+)
+
+# Login of the token's owner; it never changes, so /user is only requested once per process
+github_login: Optional[str] = None
+
+# Pooled HTTP/2 client for the evaluation-server callbacks: retries and concurrent tasks share
+# keep-alive connections instead of paying a TCP+TLS handshake every time
+evaluation_http = httpx.AsyncClient(
+    http2=True,
+    timeout=20.0,
+    limits=httpx.Limits(max_keepalive_connections=32)
+)
+
+# Content-addressed cache of parsed LLM outputs, so a brief that was already solved (a retried
+# task, or the same brief/checks/attachments under another task id) skips the LLM call
+llm_cache = diskcache.Cache("/tmp/llm_cache")
+
+# Concurrency caps that keep bursts below the OpenAI/AIPipe and GitHub rate limits
+MAX_INFLIGHT_TASKS = 8
+MAX_CONCURRENT_LLM_CALLS = 4
+MAX_CONCURRENT_GITHUB_WRITES = 6
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+github_write_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GITHUB_WRITES)
+# Blob uploads fan out per file; cap them to stay under GitHub's secondary rate limits
+MAX_CONCURRENT_BLOB_UPLOADS = 4
+blob_upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BLOB_UPLOADS)
+
+# Client-side token bucket that paces LLM calls below the per-minute quota instead of hitting 429s
+LLM_REQUESTS_PER_MINUTE = 60
+llm_rate_limiter = AsyncLimiter(max_rate=LLM_REQUESTS_PER_MINUTE, time_period=60)
+
+# Accepted tasks wait in a bounded queue and are drained by a fixed pool of MAX_INFLIGHT_TASKS
+# workers, so a burst of requests can neither start unbounded LLM/GitHub flows nor hold an
+# unbounded number of decoded attachments in memory
+MAX_QUEUED_TASKS = 100
+task_queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_TASKS)
+# Strong references to the worker tasks so they aren't garbage collected
+task_workers: list[asyncio.Task] = []
+
+# use_batch tasks can wait hours for the Batch API, so they get their own small queue and pool
+# and never occupy a real-time worker
+MAX_INFLIGHT_BATCH_TASKS = 4
+batch_task_queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_TASKS)
+batch_task_workers: list[asyncio.Task] = []
 
 
 ## --- 2. DATA MODELS ---
@@ -52,6 +157,14 @@ class TaskRequest(BaseModel):
     evaluation_url: str
     # Updated to use the new Attachment model for clarity and validation
     attachments: list[Attachment] = Field(default_factory=list)
+    # Opt-in: route generation through the (half-price, slower) Batch API when the evaluation window allows it
+    use_batch: bool = False
+
+# Structure of the files the LLM returns (enforced server-side via structured outputs)
+class GeneratedFiles(BaseModel):
+    html: str
+    readme: str
+    license: Optional[str] = None
 
 # --- NEW: Helper to construct the unique repository name ---
 def get_repo_name(task_id: str) -> str:
@@ -61,47 +174,150 @@ def get_repo_name(task_id: str) -> str:
 
 ## --- 3. HELPER FUNCTIONS (The Core Logic) ---
 
-def get_attachment_context(attachments: list[Attachment]) -> tuple[list, str]:
+def parse_data_url(url: str) -> Optional[tuple[str, bool, str]]:
+    """
+    Splits a data URL (data:<mediatype>[;base64],<data>) into (mime_type, is_base64, data).
+    Only the short header before the first comma is inspected; the payload is sliced off untouched.
+    Returns None if the URL is not a data URL.
+    """
+    header, separator, data = url.partition(",")
+    if not separator or not header.startswith("data:"):
+        return None
+    is_base64 = header.endswith(";base64")
+    mime_type = header[5:-7] if is_base64 else header[5:]
+    return mime_type, is_base64, data
+
+
+# Chunk size for streaming base64 decodes
+BASE64_CHUNK_SIZE = 64 * 1024
+
+# Every byte that is not part of the base64 alphabet (line breaks, spaces, ...), removed before decoding
+BASE64_NON_ALPHABET = bytes(
+    set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+)
+
+def decode_base64_text(encoded_data: str) -> str:
+    """
+    Decodes a base64 payload to UTF-8 text in fixed-size chunks.
+    Unlike base64.b64decode, this never makes a full ASCII-bytes copy of the encoded input;
+    only one chunk of it is materialised at a time while the decoded bytes accumulate.
+    Line-wrapped (MIME style) input is accepted: whitespace is dropped, and any characters left
+    over after the last whole 4-character quantum are carried into the next chunk.
+    """
+    decoded = bytearray()
+    carry = b""
+    for start in range(0, len(encoded_data), BASE64_CHUNK_SIZE):
+        chunk = carry + encoded_data[start:start + BASE64_CHUNK_SIZE].encode("ascii").translate(
+            None, BASE64_NON_ALPHABET
+        )
+        whole = len(chunk) - len(chunk) % 4
+        decoded += binascii.a2b_base64(chunk[:whole])
+        carry = chunk[whole:]
+    if carry:
+        decoded += binascii.a2b_base64(carry)
+    return decoded.decode("utf-8")
+
+
+# Whitespace allowed between base64 characters (line-wrapped payloads), and the full base64 alphabet
+BASE64_WHITESPACE = b" \t\r\n\v\f"
+BASE64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+def is_valid_base64(encoded_data: str) -> bool:
+    """
+    Checks that a (possibly line-wrapped) payload is well-formed base64 without decoding it.
+    Like decode_base64_text, only one chunk of ASCII bytes exists at a time, and nothing decoded is kept.
     """
-    Decodes attachments and prepares them for the LLM.
-    Returns: A list of message content blocks (for vision) and a string of text context.
+    length = 0
+    padding = 0
+    for start in range(0, len(encoded_data), BASE64_CHUNK_SIZE):
+        try:
+            chunk = encoded_data[start:start + BASE64_CHUNK_SIZE].encode("ascii").translate(None, BASE64_WHITESPACE)
+        except UnicodeEncodeError:
+            return False
+        if chunk.translate(None, BASE64_ALPHABET + b"="):
+            return False
+        # "=" may only appear as a run at the very end of the payload
+        first_pad = 0 if padding else chunk.find(b"=")
+        if first_pad >= 0:
+            if chunk[first_pad:].strip(b"="):
+                return False
+            padding += len(chunk) - first_pad
+        length += len(chunk)
+    return length % 4 == 0 and padding <= 2
+
+
+# Data attachments that are also committed to the repo, so the generated index.html can fetch() them
+COMMITTED_MIME_TYPES = {"text/csv", "application/json", "text/markdown"}
+
+# How common attachment MIME types are handled: "image" goes to the vision model, "text" is decoded
+# into the prompt. Anything not listed falls back to prefix/suffix checks in classify_mime_type().
+MIME_CATEGORIES = {
+    "image/png": "image",
+    "image/jpeg": "image",
+    "image/webp": "image",
+    "image/gif": "image",
+    "text/plain": "text",
+    "text/csv": "text",
+    "text/markdown": "text",
+    "text/html": "text",
+    "application/json": "text",
+}
+
+def classify_mime_type(mime_type: str) -> Optional[str]:
+    """Returns "image", "text", or None (unsupported) for a MIME type without parameters."""
+    category = MIME_CATEGORIES.get(mime_type)
+    if category is None:
+        if mime_type.startswith("image/"):
+            category = "image"
+        elif mime_type.startswith("text/") or mime_type.endswith(("/json", "/csv")):
+            category = "text"
+    return category
+
+def get_attachment_context(attachments: list[Attachment]) -> tuple[list, str, list[Attachment]]:
+    """
+    Decodes attachments and prepares them for the LLM, classifying each one in a single pass.
+    Returns: A list of message content blocks (for vision), a string of text context,
+    and the attachments that must be committed to the repo (text/data files).
     """
     llm_content_blocks = []
-    text_context = ""
+    # Fragments are collected and joined once at the end instead of re-copying a growing string
+    text_parts: list[str] = []
+    attachments_to_commit = []
 
     for attachment in attachments:
         # Data URLs follow the format: data:<mediatype>[;base64],<data>
-        match = re.match(r"data:(.*?)(;base64)?,(.*)", attachment.url, re.DOTALL)
-        if not match:
+        parsed = parse_data_url(attachment.url)
+        if not parsed:
             print(f"⚠️ Skipping attachment: {attachment.name}. URL format is invalid.")
             continue
             
-        mime_type = match.group(1)
-        is_base64 = match.group(2)
-        encoded_data = match.group(3)
+        mime_type, is_base64, encoded_data = parsed
 
         if not is_base64:
             print(f"⚠️ Skipping attachment: {attachment.name}. Data is not Base64 encoded.")
             continue
 
-        try:
-            # Prepare the Base64 prefix for the LLM image block
-            base64_data_prefix = f"data:{mime_type}{is_base64},{encoded_data}"
+        # Classify from the already-parsed header (ignoring parameters like ;charset=utf-8)
+        base_mime_type = mime_type.split(";", 1)[0]
+        if base_mime_type in COMMITTED_MIME_TYPES:
+            attachments_to_commit.append(attachment)
+        category = classify_mime_type(base_mime_type)
 
+        try:
             # --- Handle Image Attachments (Vision Model) ---
-            if mime_type.startswith('image/'):
+            if category == "image":
                 print(f"🖼️ Found image attachment: {attachment.name}. Adding as vision input.")
                 llm_content_blocks.append({
                     "type": "image_url",
-                    "image_url": {"url": base64_data_prefix}
+                    "image_url": {"url": attachment.url}
                 })
-                text_context += f"The user has provided an image named '{attachment.name}' for visual reference. You must follow instructions related to this image."
+                text_parts.append(f"The user has provided an image named '{attachment.name}' for visual reference. You must follow instructions related to this image.")
 
             # --- Handle Text/Data Attachments (CSV, Markdown, JSON) ---
-            elif mime_type.startswith('text/') or mime_type.endswith('/json') or mime_type.endswith('/csv'):
+            elif category == "text":
                 print(f"📄 Found text/data attachment: {attachment.name}. Decoding content.")
-                decoded_content = base64.b64decode(encoded_data).decode('utf-8')
-                text_context += (
+                decoded_content = decode_base64_text(encoded_data)
+                text_parts.append(
                     f"\n---\nFILE: {attachment.name} ({mime_type})\n"
                     f"CONTENT:\n{decoded_content}\n---\n"
                 )
@@ -114,359 +330,606 @@ def get_attachment_context(attachments: list[Attachment]) -> tuple[list, str]:
             print(f"❌ Failed to process attachment {attachment.name}: {e}")
             continue
 
-    return llm_content_blocks, text_context
+    return llm_content_blocks, "".join(text_parts), attachments_to_commit
 
 
-def generate_code_from_brief(
+async def run_batch_completion(custom_id: str, body: dict) -> str:
+    """
+    Submits a single chat completion through the Batch API and waits for it to finish.
+    Returns the message content of the completion, exactly like the real-time endpoint would.
+    """
+    print(f"📦 Submitting batch request for: {custom_id}")
+    request_line = json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body,
+    })
+    batch_file = await batch_client.files.create(
+        file=(f"{custom_id}.jsonl", request_line.encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await batch_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    # Poll with exponential backoff (5, 10, 20, 40, 60, 60, ... seconds) until the batch settles
+    delay = 5
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+        batch = await batch_client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}' and no output.")
+
+    output = await batch_client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        if result.get("custom_id") != custom_id:
+            continue
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            raise RuntimeError(f"Batch request {custom_id} failed: {result.get('error') or response}")
+        print(f"✅ Batch {batch.id} completed.")
+        return response["body"]["choices"][0]["message"]["content"]
+
+    raise RuntimeError(f"Batch {batch.id} output did not contain a result for {custom_id}.")
+
+
+# --- Prompt Templates (Hardened) ---
+# All static instructions (rules + the output format for BOTH rounds) live in one system message
+# that is built once at import time and is byte-identical for every task. The per-task
+# mode/brief/checks/context/code go in the user message after it, so the provider's automatic
+# prompt cache can reuse the whole system prefix across all tasks and both rounds.
+SYSTEM_PROMPT = """
+You are an expert, highly precise, and efficient web developer. Your goal is to write a single-page, self-contained web application (HTML/CSS/JS) that perfectly meets the user's requirements.
+
+CRITICAL RULES:
+1. STRICT FORMAT: Your response MUST be a single JSON object with the required file contents as string values, and nothing else.
+2. SINGLE FILE: The application logic MUST be self-contained within the <script> tags of index.html. Do not create separate .js or .css files.
+3. ATTACHMENT USE: If data files (CSV, JSON, MD, etc.) are provided in the user message, your JavaScript code MUST load and process them (using `fetch(filename)`) as part of the app logic. If an image is provided, generate code based on the image's appearance or content as requested in the brief.
+
+The user message states the TASK MODE. Follow the output rules for that mode.
+
+TASK MODE: CREATION (Round 1)
+Your response MUST contain exactly three keys for the following files:
+- "html": the full **index.html**, starting with <!DOCTYPE html>.
+- "readme": the **README.md** in markdown. A brief summary of the project. Include setup, usage, code explanation, and license mention.
+- "license": the **LICENSE**, containing the full text of the MIT License, which is publicly available.
+
+TASK MODE: REVISION (Round 2)
+The ORIGINAL CODE (index.html) to be REVISED is provided at the end of the user message. You MUST read this code to apply the revisions correctly.
+Your response MUST contain exactly two keys:
+- "html": the FULL REVISED **index.html**, starting with <!DOCTYPE html>.
+- "readme": the FULL REVISED **README.md** in markdown.
+Do not include a license.
+"""
+# Per-task user message skeletons; only the {slots} are filled in per call.
+# Round 2 appends the code to revise at the very end.
+ROUND1_USER_PROMPT_TEMPLATE = """
+TASK MODE: CREATION (Round 1)
+
+BRIEF: "{brief}"
+EVALUATION CHECKS: The final page must satisfy these functional requirements: {checks}.
+
+--- ATTACHMENT DATA CONTEXT ---
+{context}
+--- END CONTEXT ---
+"""
+
+ROUND2_USER_PROMPT_TEMPLATE = """
+TASK MODE: REVISION (Round 2)
+
+BRIEF: "{brief}"
+EVALUATION CHECKS: The final page must satisfy these functional requirements: {checks}.
+
+--- ATTACHMENT DATA CONTEXT ---
+{context}
+--- END CONTEXT ---
+
+--- ORIGINAL CODE (index.html) ---
+{existing_code}
+--- END ORIGINAL CODE ---
+"""
+
+# JSON schemas passed as `response_format`, so the model returns the files as structured output
+# instead of markdown code blocks that have to be scraped out of free text
+def files_response_format(include_license: bool) -> dict:
+    """Builds the strict json_schema response format for one round's output files."""
+    keys = ["html", "readme", "license"] if include_license else ["html", "readme"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "generated_files",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "string"} for key in keys},
+                "required": keys,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+ROUND1_RESPONSE_FORMAT = files_response_format(include_license=True)
+ROUND2_RESPONSE_FORMAT = files_response_format(include_license=False)
+
+
+async def generate_code_from_brief(
     brief: str, 
     checks: list, 
     attachment_blocks: list, 
     attachment_text_context: str, 
-    existing_code: str = None
+    existing_code: str = None,
+    use_batch: bool = False,
+    task_id: str = None
 ) -> dict:
     """
     Calls the OpenAI API (proxied via AIPipe) to generate code/revision.
     Includes explicit instructions for using attachments and strict adherence to the output format.
+    With `use_batch`, the prompt is submitted through the Batch API instead of the real-time endpoint.
     """
+    # The key covers every input to the prompt (but not the task id), so identical requests are
+    # answered from the cache no matter which task they arrive under. Parts are fed one by one so
+    # large attachments/existing code are never copied into one big joined string.
+    image_urls = [block["image_url"]["url"] for block in attachment_blocks]
+    hasher = blake3()
+    for part in (
+        "revision" if existing_code else "creation",
+        brief,
+        str(len(checks)), *sorted(checks),
+        attachment_text_context or "",
+        str(len(image_urls)), *image_urls,
+        existing_code or "",
+    ):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\x00")
+    cache_key = hasher.hexdigest()
+    # diskcache is SQLite-backed (blocking file I/O), so it is used from a worker thread
+    cached_result = await asyncio.to_thread(llm_cache.get, cache_key)
+    if cached_result is not None:
+        print("♻️ Returning cached LLM output for identical brief/checks/attachments/code.")
+        return cached_result
+
     print(f"🤖 Calling OpenAI (via AIPipe) for {'revision' if existing_code else 'initial generation'}...")
     
     # --- MODEL SELECTION ---
     # Using the multi-modal model to handle both image (vision) and text attachments.
     MODEL_NAME = "openai/gpt-4o-mini" 
     
-    # --- Base Instruction Template (Hardened) ---
-    base_instruction = f"""
-    You are an expert, highly precise, and efficient web developer. Your goal is to write a single-page, self-contained web application (HTML/CSS/JS) that perfectly meets the user's requirements.
-
-    CRITICAL RULES:
-    1. STRICT FORMAT: Your response MUST contain ONLY the required markdown code blocks and nothing else.
-    2. SINGLE FILE: The application logic MUST be self-contained within the <script> tags of index.html. Do not create separate .js or .css files.
-    3. ATTACHMENT USE: If data files (CSV, JSON, MD, etc.) are provided below, your JavaScript code MUST load and process them (using `fetch(filename)`) as part of the app logic. If an image is provided, generate code based on the image's appearance or content as requested in the brief.
-
-    BRIEF: "{brief}"
-    EVALUATION CHECKS: The final page must satisfy these functional requirements: {', '.join(checks)}.
-
-    --- ATTACHMENT DATA CONTEXT ---
-    {attachment_text_context if attachment_text_context else "No text/data files were provided."}
-    --- END CONTEXT ---
-    """
-    
-    if existing_code:
-        # Round 2: Instruct the LLM to modify the existing code
-        prompt_text = base_instruction + f"""
-        
-        TASK MODE: REVISION (Round 2)
-        The ORIGINAL CODE (index.html) to be REVISED is provided below. You MUST read this code to apply the revisions correctly.
-        ---
-        {existing_code}
-        ---
-
-        Your response MUST contain exactly two markdown code blocks: one for the **new index.html** and one for the **revised README.md**.
-        Do not include a LICENSE block.
-
-        Use this exact format for your output:
-        ```html
-        <!DOCTYPE html>
-        ... (FULL REVISED HTML) ...
-        ```
-
-        ```markdown
-        # Project Title - Revised
-        ... (FULL REVISED README CONTENT) ...
-        ```
-        """
-        
-    else:
-        # Round 1: Instruct the LLM to generate the initial files
-        prompt_text = base_instruction + f"""
-        
-        TASK MODE: CREATION (Round 1)
-        
-        Your response MUST contain exactly three markdown code blocks for the following files: **index.html**, **README.md**, and **LICENSE**.
-        The LICENSE block must contain the full text of the MIT License, which is publicly available.
-
-        Use this exact format for your output:
-        ```html
-        <!DOCTYPE html>
-        <html lang="en">
-        ...
-        </html>
-        ```
-
-        ```markdown
-        # Project Title
-        A brief summary of the project. Include setup, usage, code explanation, and license mention.
-        ```
-
-        ```text
-        MIT License
-        ... (the rest of the full MIT license text) ...
-        ```
-        """
+    # --- Prompt: dynamic task details only (the static part is SYSTEM_PROMPT) ---
+    # One format call fills the slots, so the (possibly large) existing code is copied only once
+    prompt_text = (ROUND2_USER_PROMPT_TEMPLATE if existing_code else ROUND1_USER_PROMPT_TEMPLATE).format(
+        brief=brief,
+        checks=", ".join(checks),
+        context=attachment_text_context or "No text/data files were provided.",
+        existing_code=existing_code
+    )
 
     # --- Construct the messages list for the LLM (Vision/Text) ---
     content_blocks = [{"type": "text", "text": prompt_text}]
     # The message sent to the API is a list containing image objects and the final text prompt
     final_message_content = attachment_blocks + content_blocks
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": final_message_content},
+    ]
+    response_format = ROUND2_RESPONSE_FORMAT if existing_code else ROUND1_RESPONSE_FORMAT
 
     try:
-        completion = openai_client.chat.completions.create(
-            model=MODEL_NAME, 
-            messages=[{"role": "user", "content": final_message_content}]
-        )
-        content = completion.choices[0].message.content
+        if use_batch:
+            # Half-price path; the response body per custom_id is identical, so parsing is unchanged
+            content = await run_batch_completion(
+                task_id or "llm-code-deployer",
+                {"model": BATCH_MODEL_NAME, "messages": messages, "response_format": response_format}
+            )
+        else:
+            # Stream the completion and accumulate the deltas as they arrive
+            async with llm_semaphore, llm_rate_limiter:
+                stream = await openai_client.chat.completions.create(
+                    model=MODEL_NAME, 
+                    messages=messages,
+                    response_format=response_format,
+                    stream=True
+                )
+                buffer = io.StringIO()
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        buffer.write(chunk.choices[0].delta.content)
+                content = buffer.getvalue()
     except Exception as e:
         print(f"❌ OpenAI API call (via AIPipe) failed: {e}")
         raise
 
-    # ... (Rest of the file parsing logic remains the same) ...
-    # This logic is robust and relies on the LLM following the strict format.
-    html_match = re.search(r"```html\n(.*?)\n```", content, re.DOTALL)
-    readme_match = re.search(r"```markdown\n(.*?)\n```", content, re.DOTALL)
-    
-    # ... (Final checks and return) ...
-    
-    # Rest of your existing parsing logic goes here...
-    if not html_match or not readme_match:
-        print("❌ Error: LLM response did not contain the required HTML and README blocks.")
+    # The response is schema-constrained JSON, so it is validated straight into the model
+    try:
+        files = GeneratedFiles.model_validate_json(content)
+    except ValidationError as e:
+        print(f"❌ Error: LLM response did not match the expected JSON structure: {e}")
         raise ValueError("Failed to parse LLM response. The output format was incorrect.")
     
     result = {
-        "html": html_match.group(1).strip(),
-        "readme": readme_match.group(1).strip(),
+        "html": files.html.strip(),
+        "readme": files.readme.strip(),
     }
     
     if not existing_code:
         # Only check for LICENSE in Round 1
-        license_match = re.search(r"```text\n(.*?)\n```", content, re.DOTALL)
-        if not license_match:
-            print("❌ Error: LLM response did not contain the required LICENSE block for Round 1.")
+        if not files.license:
+            print("❌ Error: LLM response did not contain the required LICENSE for Round 1.")
             raise ValueError("Failed to parse LLM response. The output format was incorrect for Round 1.")
-        result["license"] = license_match.group(1).strip()
+        result["license"] = files.license.strip()
     
     print("✅ Code generated/revised successfully.")
+    await asyncio.to_thread(llm_cache.set, cache_key, result)
     return result
 
 
-def create_and_deploy_repo(repo_name: str, files: dict) -> dict:
+async def github_request(method: str, path: str, **kwargs) -> dict:
+    """
+    Sends a request to the GitHub REST API over the shared HTTP/2 connection pool.
+    Raises httpx.HTTPStatusError for non-2xx responses so callers can inspect the status code.
+    """
+    response = await github_http.request(method, path, **kwargs)
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+
+async def get_github_login() -> str:
+    """Returns the login of the user that owns GITHUB_TOKEN (fetched once, then reused)."""
+    global github_login
+    if github_login is None:
+        user = await github_request("GET", "/user")
+        github_login = user["login"]
+    return github_login
+
+
+async def get_file_text(owner: str, repo_name: str, path: str) -> str:
+    """Returns a file's body as text using the raw media type (no JSON envelope, no base64 decode)."""
+    response = await github_http.get(
+        f"/repos/{owner}/{repo_name}/contents/{path}",
+        headers={"Accept": "application/vnd.github.raw"}
+    )
+    response.raise_for_status()
+    return response.text
+
+
+def encode_content(text: str) -> str:
+    """Base64-encodes a text file body for the GitHub API."""
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+async def create_blob(owner: str, repo_name: str, encoded_content: str) -> str:
+    """Uploads a base64-encoded file body as a git blob and returns its SHA."""
+    async with blob_upload_semaphore:
+        blob = await github_request("POST", f"/repos/{owner}/{repo_name}/git/blobs", json={
+            "content": encoded_content,
+            "encoding": "base64",
+        })
+    return blob["sha"]
+
+
+# Delays between reads of a branch that may not exist yet (a repo created moments ago with auto_init)
+BRANCH_READ_RETRY_DELAYS = (0.5, 1, 2, 4)
+
+async def get_branch_head(owner: str, repo_name: str) -> dict:
+    """
+    Returns the main branch of a repo. A freshly auto-initialised repo can briefly answer 404/409
+    while its first commit is being written, so those are retried with a short backoff.
+    """
+    for delay in BRANCH_READ_RETRY_DELAYS:
+        try:
+            return await github_request("GET", f"/repos/{owner}/{repo_name}/branches/main")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in (404, 409):
+                raise
+            print(f"⚠️ Branch main of {repo_name} is not ready yet ({e.response.status_code}). Retrying in {delay}s...")
+            await asyncio.sleep(delay)
+    # Last attempt; any error now propagates to the caller
+    return await github_request("GET", f"/repos/{owner}/{repo_name}/branches/main")
+
+
+async def commit_files(owner: str, repo_name: str, files: dict, message: str) -> str:
+    """
+    Writes several files to main as ONE commit using the Git Data API (blobs -> tree -> commit -> ref).
+    `files` maps repo paths to their base64-encoded content. Returns the SHA of the new commit.
+    """
+    branch = await get_branch_head(owner, repo_name)
+    parent_sha = branch["commit"]["sha"]
+    base_tree_sha = branch["commit"]["commit"]["tree"]["sha"]
+
+    # Blobs for distinct files are independent, so they are uploaded concurrently (bounded by create_blob)
+    paths = list(files)
+    blob_shas = await asyncio.gather(*(create_blob(owner, repo_name, files[path]) for path in paths))
+
+    tree = await github_request("POST", f"/repos/{owner}/{repo_name}/git/trees", json={
+        "base_tree": base_tree_sha,
+        "tree": [
+            {"path": path, "mode": "100644", "type": "blob", "sha": sha}
+            for path, sha in zip(paths, blob_shas)
+        ],
+    })
+    commit = await github_request("POST", f"/repos/{owner}/{repo_name}/git/commits", json={
+        "message": message,
+        "tree": tree["sha"],
+        "parents": [parent_sha],
+    })
+    await github_request("PATCH", f"/repos/{owner}/{repo_name}/git/refs/heads/main", json={"sha": commit["sha"]})
+    return commit["sha"]
+
+
+# Files the pipeline itself writes; attachments may not replace them
+GENERATED_FILE_NAMES = {"index.html", "README.md", "LICENSE"}
+
+def is_safe_repo_path(name: str) -> bool:
+    """
+    True if `name` is a clean relative path that GitHub accepts in a tree: no empty, "." or ".."
+    segments, no leading "/", and nothing inside .git. One bad path would fail the whole commit.
+    """
+    return all(segment not in ("", ".", "..") and segment.lower() != ".git" for segment in name.split("/"))
+
+def stage_attachments(files_to_commit: dict, attachments: list[Attachment]) -> None:
+    """
+    Adds the data-URL payloads of `attachments` to `files_to_commit` (path -> base64 content).
+    Payloads are committed as-is (they are already base64), but each one is validated first, and
+    attachments that are malformed, have an unusable path, or would overwrite a generated file are
+    skipped, so one bad attachment cannot fail the whole commit.
+    """
+    for attachment in attachments:
+        if attachment.name in GENERATED_FILE_NAMES:
+            print(f"⚠️ Attachment {attachment.name} would overwrite a generated file. Skipping commit.")
+            continue
+        if not is_safe_repo_path(attachment.name):
+            print(f"⚠️ Attachment name {attachment.name!r} is not a valid repo path. Skipping commit.")
+            continue
+        parsed = parse_data_url(attachment.url)
+        if not parsed or not parsed[1]:
+            print(f"⚠️ Could not parse data URL for file {attachment.name}. Skipping commit.")
+            continue
+        # Make sure the payload is valid base64 before GitHub sees it, then drop the line wrapping
+        if not is_valid_base64(parsed[2]):
+            print(f"⚠️ Data file {attachment.name} is not valid base64. Skipping commit.")
+            continue
+        files_to_commit[attachment.name] = "".join(parsed[2].split())
+        print(f"✅ Data file {attachment.name} staged for commit.")
+
+
+async def create_and_deploy_repo(repo_name: str, files: dict) -> dict:
     """Creates a GitHub repo, uploads files, and constructs the Pages URL (used only for Round 1)."""
     print(f"🐙 Accessing GitHub to create repo: {repo_name}")
-    user = github_client.get_user()
+    login = await get_github_login()
     
     try:
-        # Create a new public repository.
-        repo = user.create_repo(repo_name, private=False, auto_init=False)
+        # Create a new public repository. It is auto-initialised so main exists for the Git Data API.
+        repo = await github_request("POST", "/user/repos", json={"name": repo_name, "private": False, "auto_init": True})
         print(f"✅ Repo '{repo_name}' created.")
-    except GithubException as e:
+    except httpx.HTTPStatusError as e:
         # If the repo already exists, fail Round 1
-        if e.status == 422:
+        if e.response.status_code == 422:
             print(f"⚠️ Repo '{repo_name}' already exists. Failing Round 1 as expected.")
             raise HTTPException(status_code=409, detail=f"Repository {repo_name} already exists. Cannot complete Round 1.")
         else:
             print(f"❌ GitHub API error: {e}")
             raise
 
-    # Upload the files generated by the LLM to the main branch
-    repo.create_file("index.html", "feat: Initial application structure", files["html"], branch="main")
-    repo.create_file("README.md", "docs: Add project README", files["readme"], branch="main")
-    repo.create_file("LICENSE", "docs: Add MIT License", files["license"], branch="main")
+    # Upload the files generated by the LLM to the main branch as a single commit
+    # (one Pages build; the generated README replaces the auto-init one)
+    files_to_commit = {
+        "index.html": encode_content(files["html"]),
+        "README.md": encode_content(files["readme"]),
+        "LICENSE": encode_content(files["license"]),
+    }
     
     # --- CRITICAL: Add the attachment files to the repo if they are text/data files ---
     # The image logic is inside the LLM prompt. For CSV/JSON, they must be in the repo
-    # so the generated index.html can load them.
-    for attachment in files.get("attachments_to_commit", []):
-        try:
-            # The 'url' contains the data: MIME;base64, content
-            match = re.match(r"data:.*?base64,(.*)", attachment["url"], re.DOTALL)
-            if match:
-                decoded_content = base64.b64decode(match.group(1)).decode('utf-8')
-                repo.create_file(attachment["name"], f"data: Add {attachment['name']}", decoded_content, branch="main")
-                print(f"✅ Data file {attachment['name']} committed to the repo.")
-            else:
-                print(f"⚠️ Could not parse data URL for file {attachment['name']}. Skipping commit.")
-        except Exception as e:
-            print(f"❌ Failed to commit data file {attachment['name']}: {e}")
+    # so the generated index.html can load them. They go into the same commit.
+    # Validation scans every payload, so it runs off the event loop like the attachment decoding
+    await asyncio.to_thread(stage_attachments, files_to_commit, files.get("attachments_to_commit", []))
 
+    # The commit response carries its SHA, so there is no need to re-read the branch
+    commit_sha = await commit_files(login, repo_name, files_to_commit, "feat: Initial application structure")
     print("✅ Files committed to the repo.")
-
-    # Giving GitHub Pages a moment to initialize the site build
-    time.sleep(5) 
     
     # Construct the GitHub Pages URL based on the GITHUB_USERNAME defined in setup
-    commit_sha = repo.get_branch("main").commit.sha
-    pages_url = f"https://{user.login}.github.io/{repo.name}/"
+    pages_url = f"https://{login}.github.io/{repo['name']}/"
     
     return {
-        "repo_url": repo.html_url,
+        "repo_url": repo["html_url"],
         "commit_sha": commit_sha,
         "pages_url": pages_url
     }
 
-def update_and_redeploy_repo(repo_name: str, files: dict) -> dict:
-    """Updates an EXISTING GitHub repo with new files (used only for Round 2)."""
-    print(f"🔄 Starting Round 2 revision for repo: {repo_name}")
-    user = github_client.get_user()
+async def get_existing_repo(repo_name: str) -> dict:
+    """Looks up the repo a Round 2 update will write to, failing with 404 if it does not exist."""
+    login = await get_github_login()
     
     try:
-        repo = user.get_repo(repo_name)
+        return await github_request("GET", f"/repos/{login}/{repo_name}")
     except Exception:
         raise HTTPException(status_code=404, detail=f"Round 2 failed: Repository '{repo_name}' not found for revision.")
 
-    # List of files we intend to commit (path, content, commit_message, sha)
-    files_to_commit = []
 
-    # 1. Update index.html
-    try:
-        contents_html = repo.get_contents("index.html")
-        files_to_commit.append({
-            "path": contents_html.path, 
-            "message": "feat: Round 2 code revision", 
-            "content": files["html"], 
-            "sha": contents_html.sha,
-        })
-        print("✅ index.html staged for update.")
-    except Exception as e:
-        print(f"❌ Failed to get index.html for update: {e}")
-        raise HTTPException(status_code=500, detail="Failed to stage application code (index.html) in repo.")
-
-    # 2. Update README.md
-    try:
-        contents_readme = repo.get_contents("README.md")
-        files_to_commit.append({
-            "path": contents_readme.path, 
-            "message": "docs: Round 2 README update", 
-            "content": files["readme"], 
-            "sha": contents_readme.sha,
-        })
-        print("✅ README.md staged for update.")
-    except Exception as e:
-        print(f"❌ Failed to get README.md for update: {e}")
-        # This is less critical than the code, but still necessary.
-        raise HTTPException(status_code=500, detail="Failed to stage documentation (README.md) in repo.")
+async def update_and_redeploy_repo(repo_name: str, files: dict, repo: dict) -> dict:
+    """Updates an EXISTING GitHub repo with new files as a single commit (used only for Round 2)."""
+    print(f"🔄 Starting Round 2 revision for repo: {repo_name}")
+    login = await get_github_login()
+
+    # Files we intend to commit (path -> base64 content). They all go into ONE tree on top of main:
+    # existing paths are overwritten, new paths are added, and untouched files are inherited,
+    # so no per-file SHA lookups are needed.
+    files_to_commit = {
+        "index.html": encode_content(files["html"]),
+        "README.md": encode_content(files["readme"]),
+    }
 
-    # 3. Handle NEW attachment files (like a new JSON/CSV provided in Round 2)
-    for attachment in files.get("attachments_to_commit", []):
-        try:
-            match = re.match(r"data:.*?base64,(.*)", attachment["url"], re.DOTALL)
-            if match:
-                decoded_content = base64.b64decode(match.group(1)).decode('utf-8')
-                
-                # Check if the file already exists (Round 2 could include a revision to an attachment)
-                try:
-                    existing_content = repo.get_contents(attachment["name"])
-                    files_to_commit.append({
-                        "path": existing_content.path,
-                        "message": f"data: Update {attachment['name']} for Round 2",
-                        "content": decoded_content,
-                        "sha": existing_content.sha,
-                    })
-                    print(f"✅ Existing data file {attachment['name']} staged for update.")
-                except GithubException as e:
-                    # File not found (404), so create it
-                    if e.status == 404:
-                         repo.create_file(attachment["name"], f"data: Add {attachment['name']} for Round 2", decoded_content, branch="main")
-                         print(f"✅ New data file {attachment['name']} committed to the repo.")
-                    else:
-                        raise e # Re-raise other GitHub errors
-        except Exception as e:
-            print(f"❌ Failed to stage/commit data file {attachment['name']}: {e}")
+    # Handle NEW or revised attachment files (like a new JSON/CSV provided in Round 2)
+    # Validation scans every payload, so it runs off the event loop like the attachment decoding
+    await asyncio.to_thread(stage_attachments, files_to_commit, files.get("attachments_to_commit", []))
     
-    # Commit all staged changes
-    commit_sha = ""
-    for file_data in files_to_commit:
-        repo.update_file(
-            file_data["path"],
-            file_data["message"],
-            file_data["content"],
-            file_data["sha"],
-            branch="main"
-        )
-        print(f"✅ Committed: {file_data['path']}")
-        
-    # Wait for the commit to process before getting the SHA
-    time.sleep(5)
+    commit_sha = await commit_files(login, repo_name, files_to_commit, "feat: Round 2 code revision")
+    print(f"✅ Committed: {', '.join(files_to_commit)}")
     
-    commit_sha = repo.get_branch("main").commit.sha
-    pages_url = f"https://{user.login}.github.io/{repo.name}/"
+    pages_url = f"https://{login}.github.io/{repo['name']}/"
     
     return {
-        "repo_url": repo.html_url,
+        "repo_url": repo["html_url"],
         "commit_sha": commit_sha,
         "pages_url": pages_url
     }
 
-def notify_evaluation_server(url: str, payload: dict):
+# Longest server-requested delay we will honour before a retry; anything longer means giving up
+MAX_RETRY_AFTER_SECONDS = 60
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """
+    Returns the delay the server asked for, if any: a `Retry-After` header (seconds or HTTP date),
+    or, when `x-ratelimit-remaining` is exhausted, the time until `x-ratelimit-reset` (UTC epoch).
+    """
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+
+    if response.headers.get("x-ratelimit-remaining") == "0":
+        try:
+            return max(float(response.headers["x-ratelimit-reset"]) - time.time(), 0.0)
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+async def notify_evaluation_server(url: str, payload: dict):
     """Sends the final results back to the instructor's server with retries (Exponential Backoff)."""
     print(f"📨 Notifying evaluation server for Round {payload.get('round')} at: {url}")
     
-    # Retry with exponential backoff (1, 2, 4, 8 seconds) up to 4 times
-    for i in range(4):
+    # Serialize once; every retry re-sends the same bytes
+    body = orjson.dumps(payload)
+    
+    # Retry with exponential backoff (1, 2, 4, 8 seconds) up to 4 times,
+    # unless the server tells us how long to wait via Retry-After / x-ratelimit-reset
+    attempts = 4
+    for i in range(attempts):
+        retry_after = None
         try:
-            response = requests.post(url, json=payload, timeout=20)
+            response = await evaluation_http.post(url, content=body, headers={"Content-Type": "application/json"})
             if response.status_code == 200:
                 print("✅ Successfully notified evaluation server.")
                 return
+            elif 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                # Client errors won't succeed on retry, so fail fast instead of sleeping through the backoff
+                print(f"❌ Attempt {i+1} failed with permanent status {response.status_code}. Not retrying.")
+                raise Exception(f"Evaluation server rejected the notification with status {response.status_code}.")
             else:
                 print(f"⚠️ Attempt {i+1} failed with status {response.status_code}. Retrying...")
-        except requests.RequestException as e:
+                retry_after = get_retry_after(response)
+        except httpx.HTTPError as e:
             print(f"⚠️ Attempt {i+1} failed with network error: {e}. Retrying...")
         
-        # Exponential Backoff delay
-        time.sleep(2**i) 
+        if i == attempts - 1:
+            break
+        if retry_after is not None:
+            if retry_after > MAX_RETRY_AFTER_SECONDS:
+                # Don't park a worker for minutes (or hours) on one notification
+                print(f"❌ Evaluation server asked to wait {retry_after:.0f}s (limit {MAX_RETRY_AFTER_SECONDS}s). Giving up.")
+                break
+            # Never retry earlier than the server asked; the small jitter only spreads retries out
+            await asyncio.sleep(retry_after + random.uniform(0, 1))
+        else:
+            # Exponential Backoff delay, with full jitter so many failing tasks don't retry in lockstep
+            await asyncio.sleep(2**i * (0.5 + random.random()))
     
     print("❌ Failed to notify evaluation server after multiple retries.")
     # Re-raise an exception so the FastAPI background task logs it as a failure
     raise Exception("Failed to notify evaluation server.")
 
 
+# --- Task Queue Workers ---
+async def task_worker(queue: asyncio.Queue):
+    """Pulls accepted requests off `queue` and processes them one at a time, forever."""
+    while True:
+        request_data = await queue.get()
+        try:
+            await process_task(request_data)
+        finally:
+            queue.task_done()
+
+
+def start_task_workers():
+    """
+    Fills the real-time and batch worker pools up to their size on the running event loop.
+    Workers that have exited are dropped and replaced, so a pool never silently shrinks.
+    """
+    for workers, queue, size in (
+        (task_workers, task_queue, MAX_INFLIGHT_TASKS),
+        (batch_task_workers, batch_task_queue, MAX_INFLIGHT_BATCH_TASKS),
+    ):
+        workers[:] = [worker for worker in workers if not worker.done()]
+        workers.extend(asyncio.create_task(task_worker(queue)) for _ in range(size - len(workers)))
+
+
 # --- Combined Background Processor ---
-def process_task(request_data: TaskRequest):
+async def process_task(request_data: TaskRequest):
     """The main workflow that runs in the background for either round."""
     repo_name = get_repo_name(request_data.task)
     print(f"🚀 Starting Round {request_data.round} processing for task: {repo_name}")
     
     try:
         # --- NEW: Process Attachments for LLM Input ---
-        # attachment_blocks is for vision (image), attachment_text_context is for text (CSV/JSON)
-        attachment_blocks, attachment_text_context = get_attachment_context(request_data.attachments)
-        
-        # Store attachments that need to be committed to the repo (text/data files)
-        attachments_to_commit = [
-            att for att in request_data.attachments 
-            if any(mime in att.url for mime in ['text/csv', 'application/json', 'text/markdown'])
-        ]
-        
+        # attachment_blocks is for vision (image), attachment_text_context is for text (CSV/JSON),
+        # attachments_to_commit are the text/data files that must also be stored in the repo
+        # Decoding multi-MB base64 payloads is CPU work, so it runs off the event loop
+        attachment_blocks, attachment_text_context, attachments_to_commit = await asyncio.to_thread(
+            get_attachment_context, request_data.attachments
+        )
+    
         existing_code = None
-        
+    
         if request_data.round == 2:
             # --- ROUND 2: REVISE ---
             # 1. Get existing code to provide context to the LLM
-            user = github_client.get_user()
-            repo = user.get_repo(repo_name)
-            
-            # Fetch the contents of the existing index.html
-            existing_contents = repo.get_contents("index.html")
-            # The content is base64 encoded, so it must be decoded
-            existing_code = base64.b64decode(existing_contents.content).decode('utf-8')
+            login = await get_github_login()
+        
+            # Fetch the existing index.html as raw UTF-8 text
+            existing_code = await get_file_text(login, repo_name, "index.html")
 
         # --- CODE GENERATION/REVISION STEP (COMMON TO BOTH ROUNDS) ---
-        generated_files = generate_code_from_brief(
+        generation = generate_code_from_brief(
             request_data.brief, 
             request_data.checks,
             attachment_blocks,
             attachment_text_context,
-            existing_code=existing_code
+            existing_code=existing_code,
+            use_batch=request_data.use_batch,
+            task_id=request_data.task
         )
+        if request_data.round == 2:
+            # The repo lookup for the update doesn't depend on the LLM output,
+            # so it runs while the (much slower) LLM call is in flight
+            generated_files, existing_repo = await asyncio.gather(
+                generation, get_existing_repo(repo_name)
+            )
+        else:
+            generated_files = await generation
         # Add attachments that need to be committed to the repo
         generated_files["attachments_to_commit"] = attachments_to_commit
 
         # --- DEPLOYMENT STEP ---
-        if request_data.round == 1:
-            # Create a new repo
-            repo_details = create_and_deploy_repo(repo_name, generated_files)
-        else: # request_data.round == 2
-            # Update the existing repo
-            repo_details = update_and_redeploy_repo(repo_name, generated_files)
+        async with github_write_semaphore:
+            if request_data.round == 1:
+                # Create a new repo
+                repo_details = await create_and_deploy_repo(repo_name, generated_files)
+            else: # request_data.round == 2
+                # Update the existing repo
+                repo_details = await update_and_redeploy_repo(repo_name, generated_files, existing_repo)
 
         # --- FINAL STEP (COMMON TO BOTH ROUNDS) ---
         payload = {
@@ -478,9 +941,9 @@ def process_task(request_data: TaskRequest):
             "commit_sha": repo_details["commit_sha"],
             "pages_url": repo_details["pages_url"],
         }
-        
-        notify_evaluation_server(request_data.evaluation_url, payload)
-        
+    
+        await notify_evaluation_server(request_data.evaluation_url, payload)
+    
     except Exception as e:
         # Log the critical failure, but allow the server to continue running.
         print(f"❌ An unrecoverable error occurred during Round {request_data.round} processing: {e}")
@@ -490,9 +953,41 @@ def process_task(request_data: TaskRequest):
 
 ## --- 4. API ENDPOINTS (The Server's "Doors") ---
 
-@app.post("/api/deploy")
-async def handle_deployment(request_data: TaskRequest, background_tasks: BackgroundTasks):
+# Request body schema for /docs. Nested models (Attachment) are referenced as OpenAPI components,
+# which openapi_with_task_request_defs() registers, instead of JSON-Schema $defs that /docs can't resolve
+TASK_REQUEST_SCHEMA = TaskRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+TASK_REQUEST_SCHEMA_DEFS = TASK_REQUEST_SCHEMA.pop("$defs", {})
+
+def openapi_with_task_request_defs() -> dict:
+    """FastAPI's generated OpenAPI schema, plus the component schemas TASK_REQUEST_SCHEMA refers to."""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(TASK_REQUEST_SCHEMA_DEFS)
+    return app.openapi_schema
+
+app.openapi = openapi_with_task_request_defs
+
+@app.post(
+    "/api/deploy",
+    status_code=202,
+    openapi_extra={"requestBody": {"content": {"application/json": {"schema": TASK_REQUEST_SCHEMA}}, "required": True}}
+)
+async def handle_deployment(request: Request):
     """This is the main endpoint that receives requests from the instructor."""
+    # The body (which can carry multi-MB data URLs) is parsed and validated in one pass by
+    # pydantic-core's JSON parser, instead of json.loads into dicts followed by validation
+    try:
+        request_data = TaskRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # Shape the errors the way FastAPI does for a typed body parameter: locations are prefixed
+        # with "body", and a malformed JSON body is not echoed back (it may be non-UTF-8, or several MB)
+        errors = []
+        for error in e.errors(include_url=False):
+            error["loc"] = ("body", *error["loc"])
+            if error["type"] == "json_invalid":
+                error["input"] = {}
+            errors.append(error)
+        raise RequestValidationError(errors)
     print(f"Received request for task: {request_data.task}, round: {request_data.round}")
 
     # Immediately verify the secret. If it's wrong, reject the request.
@@ -500,12 +995,21 @@ async def handle_deployment(request_data: TaskRequest, background_tasks: Backgro
         print("❌ Secret mismatch. Aborting.")
         raise HTTPException(status_code=403, detail="Invalid secret provided.")
 
+    if request_data.use_batch and batch_client is None:
+        raise HTTPException(status_code=400, detail="Batch mode is not configured on this server (OPENAI_BATCH_API_KEY is not set).")
+
     # Check if the round is valid and add the task to the background
     if request_data.round in [1, 2]:
-        # Crucially, we add the slow work as a background task.
-        # This allows us to return a 200 OK response immediately, which is essential
+        # Crucially, we hand the slow work to the worker queue.
+        # This allows us to return a 202 Accepted response immediately, which is essential
         # for not blocking the external evaluation server.
-        background_tasks.add_task(process_task, request_data)
+        # (Workers normally start with the app; starting them here covers hosts without lifespan events.)
+        start_task_workers()
+        queue = batch_task_queue if request_data.use_batch else task_queue
+        try:
+            queue.put_nowait(request_data)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Too many tasks are queued. Please retry later.")
         return {"status": "success", "message": f"Round {request_data.round} task accepted and is being processed in the background."}
     
     else:
@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import os
+import sys
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+# main.py refuses to import without its secrets; dummy values are enough for the pure helpers
+os.environ.setdefault("MY_SECRET", "test-secret")
+os.environ.setdefault("GITHUB_TOKEN", "test-token")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def test_decode_base64_text_accepts_line_wrapped_input():
+    text = "name,score\n" + "".join(f"row{i},{i}\n" for i in range(500))
+    wrapped = base64.encodebytes(text.encode("utf-8")).decode("ascii")
+    assert "\n" in wrapped.strip()
+    assert main.decode_base64_text(wrapped) == text
+
+
+def test_decode_base64_text_spans_multiple_chunks():
+    text = "é" + "x" * (main.BASE64_CHUNK_SIZE * 2) + "✓"
+    encoded = base64.b64encode(text.encode("utf-8")).decode("ascii")
+    assert len(encoded) > main.BASE64_CHUNK_SIZE
+    assert main.decode_base64_text(encoded) == text
+
+
+def test_decode_base64_text_wrapped_input_spans_multiple_chunks():
+    text = "".join(chr(ord("a") + i % 26) for i in range(main.BASE64_CHUNK_SIZE * 2))
+    wrapped = base64.encodebytes(text.encode("utf-8")).decode("ascii")
+    assert main.decode_base64_text(wrapped) == text
+
+
+def data_url(payload: str, mime_type: str = "text/csv") -> str:
+    return f"data:{mime_type};base64,{payload}"
+
+
+def test_is_valid_base64():
+    assert main.is_valid_base64(base64.encodebytes(b"x" * 200_000).decode("ascii"))
+    assert main.is_valid_base64("YWJj")
+    assert not main.is_valid_base64("YWJ")
+    assert not main.is_valid_base64("YW=j")
+    assert not main.is_valid_base64("YWJj!")
+    assert not main.is_valid_base64("YWJjé")
+
+
+def test_stage_attachments_stages_valid_payloads_without_line_wrapping():
+    wrapped = base64.encodebytes(b"a,b\n" * 100).decode("ascii")
+    files = {}
+    main.stage_attachments(files, [main.Attachment(name="data/input.csv", url=data_url(wrapped))])
+    assert files == {"data/input.csv": "".join(wrapped.split())}
+
+
+def test_stage_attachments_skips_invalid_base64():
+    files = {}
+    main.stage_attachments(files, [main.Attachment(name="data.csv", url=data_url("not*base64"))])
+    assert files == {}
+
+
+def test_stage_attachments_skips_non_base64_data_urls():
+    files = {}
+    main.stage_attachments(files, [main.Attachment(name="data.csv", url="data:text/csv,a,b")])
+    assert files == {}
+
+
+def test_stage_attachments_does_not_overwrite_generated_files():
+    files = {"index.html": "PGh0bWw+", "README.md": "IyBSRUFETUU=", "LICENSE": "TUlU"}
+    attachments = [main.Attachment(name=name, url=data_url("YWJj")) for name in main.GENERATED_FILE_NAMES]
+    main.stage_attachments(files, attachments)
+    assert files == {"index.html": "PGh0bWw+", "README.md": "IyBSRUFETUU=", "LICENSE": "TUlU"}
+
+
+def test_stage_attachments_skips_unsafe_paths():
+    names = ["", "../evil.csv", "/abs.csv", "a//b.csv", "./a.csv", "dir/", ".git/config", "x/.GIT/hooks"]
+    files = {}
+    main.stage_attachments(files, [main.Attachment(name=name, url=data_url("YWJj")) for name in names])
+    assert files == {}
+
+
+def test_get_retry_after_seconds():
+    assert main.get_retry_after(httpx.Response(429, headers={"Retry-After": "7"})) == 7.0
+    assert main.get_retry_after(httpx.Response(429, headers={"Retry-After": "-3"})) == 0.0
+
+
+def test_get_retry_after_http_date():
+    response = httpx.Response(503, headers={"Retry-After": formatdate(time.time() + 30, usegmt=True)})
+    assert 25 <= main.get_retry_after(response) <= 30
+
+
+def test_get_retry_after_ratelimit_reset():
+    headers = {"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(int(time.time()) + 20)}
+    assert 15 <= main.get_retry_after(httpx.Response(429, headers=headers)) <= 20
+
+
+def test_get_retry_after_ignores_reset_while_requests_remain():
+    headers = {"x-ratelimit-remaining": "5", "x-ratelimit-reset": str(int(time.time()) + 20)}
+    assert main.get_retry_after(httpx.Response(429, headers=headers)) is None
+    assert main.get_retry_after(httpx.Response(429, headers={"Retry-After": "soon"})) is None
+
+
+def test_notify_evaluation_server_gives_up_on_long_retry_after(monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(429, headers={"Retry-After": str(main.MAX_RETRY_AFTER_SECONDS + 1)})
+
+    async def no_sleep(delay):
+        raise AssertionError(f"slept for {delay}s")
+
+    monkeypatch.setattr(main, "evaluation_http", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main.asyncio, "sleep", no_sleep)
+    with pytest.raises(Exception, match="Failed to notify"):
+        asyncio.run(main.notify_evaluation_server("https://example.com/notify", {"round": 1}))
+    assert len(requests) == 1